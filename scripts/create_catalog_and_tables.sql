@@ -5,5 +5,5 @@ CREATE CATALOG IF NOT EXISTS gds_de_bootcamp;
 CREATE SCHEMA IF NOT EXISTS gds_de_bootcamp.default;
 
 -- Note:
--- booking_fact and customer_scd will be created automatically by the ETL script
+-- bookings_bronze, customers_bronze, booking_silver, booking_fact and customer_scd will be created automatically by the ETL script
 -- when df.write.saveAsTable(...) runs.